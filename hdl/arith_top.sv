@@ -0,0 +1,37 @@
+/**
+  ******************************************************************************
+  * Simulation top level for arith: generates pclk on the HDL side so the
+  * clock does not have to be toggled from Python.
+  ******************************************************************************
+**/
+module arith_top #(
+        parameter CLK_PERIOD_NS = 20
+    ) ();
+
+	logic pclk = 0;
+	logic presetn;
+	logic [31:0] paddr;
+	logic [31:0] pwdata;
+	logic  psel;
+	logic  pwrite;
+	logic  penable;
+	logic [31:0] prdata;
+	logic  pslverr;
+	logic  pready;
+
+	always #(CLK_PERIOD_NS/2) pclk = ~pclk;
+
+	arith dut (
+		.pclk(pclk),
+		.presetn(presetn),
+		.paddr(paddr),
+		.pwdata(pwdata),
+		.psel(psel),
+		.pwrite(pwrite),
+		.penable(penable),
+		.prdata(prdata),
+		.pslverr(pslverr),
+		.pready(pready)
+	);
+
+endmodule
@@ -1,97 +1,148 @@
 import random
 import logging
-import warnings
-import copy
+
+from collections import deque
+
+import numpy as np
+from numba import njit
 
 import cocotb
 
-from cocotb.clock import Clock
-from cocotb.triggers import Timer, RisingEdge, ReadOnly, FallingEdge
-from cocotb.drivers import BusDriver, ValidatedBusDriver
+from cocotb.triggers import Timer, RisingEdge, ReadOnly
+from cocotb.drivers import BusDriver
 from cocotb.monitors import BusMonitor
-from cocotb.regression import TestFactory
-from cocotb.scoreboard import Scoreboard
-from cocotb.utils import hexdump
-from cocotb.binary import BinaryValue, BinaryRepresentation
-from cocotb.result import TestError
 from cocotb.result import TestFailure, TestSuccess
-from cocotb_coverage.coverage import *
-from cocotb_coverage.crv import *
+from cocotb_coverage.crv import Randomized
 
-CLK_PERIOD_NS = 20
+NUM_TRANSACTIONS = 10000
 
 class APBTransaction(Randomized):
     '''
     APB Transaction
     '''
 
-    def __init__(self, DATA_WIDTH = 32, ADDR_SIZE = 32, ADDR_MAX = 4):
+    __slots__ = ('data', 'addr', 'rw', 'slverr')
+
+    ADDR_MAX = 4
+    ADDR_DOMAIN = list(range(ADDR_MAX*4))
+    RW_DOMAIN = [0, 1]
+
+    # Seeded from the global generator, which cocotb seeds with RANDOM_SEED,
+    # so runs stay reproducible.
+    _rng = random.Random(random.getrandbits(64))
+
+    def __init__(self, DATA_WIDTH = 32, ADDR_SIZE = 32, ADDR_MAX = ADDR_MAX):
 
         Randomized.__init__(self)
 
         self.data = None
         self.addr = None
         self.rw = None
-        self.slverr = BinaryValue(n_bits=1, value=0, bigEndian=False)
+        self.slverr = 0
 
-        self.add_rand("addr",list(range(ADDR_MAX*4)))
-        self.add_rand("rw"  ,list([0,1]))
+        if (ADDR_MAX == APBTransaction.ADDR_MAX):
+            self.add_rand("addr", APBTransaction.ADDR_DOMAIN)
+        else:
+            self.add_rand("addr", list(range(ADDR_MAX*4)))
+        self.add_rand("rw"  , APBTransaction.RW_DOMAIN)
 
     def post_randomize(self):
-        self.data = random.randint(0,0xFFFFFFFF)
-
-        self.data = BinaryValue(value=self.data, n_bits=32, bigEndian=False)
-        self.addr = BinaryValue(value=self.addr, n_bits=32, bigEndian=False)
-        self.rw   = BinaryValue(value=self.rw, n_bits=1, bigEndian=False)
+        self.data = self._rng.getrandbits(32)
+
+    def fast_randomize(self):
+        '''
+        Uniform randomization over the default address range without going
+        through the CRV solver. Only valid while no constraints are added
+        to the transaction; also works on instances built by clone().
+        '''
+        rng = APBTransaction._rng
+        self.addr = rng.randrange(APBTransaction.ADDR_MAX*4)
+        self.rw = rng.getrandbits(1)
+        self.data = rng.getrandbits(32)
+        self.slverr = 0
+
+    def clone(self):
+        '''
+        Shallow copy that skips Randomized.__init__ and add_rand.
+        '''
+        t = APBTransaction.__new__(APBTransaction)
+        t.data = self.data
+        t.addr = self.addr
+        t.rw = self.rw
+        t.slverr = self.slverr
+        return t
 
     def print_tr(self):
-        print ("Data: ", self.data, " Addr: ", self.addr, " RW: ", self.rw, " SLVERR: ", self.slverr)
+        print (self)
+
+    def __str__(self):
+        return "Data: {} Addr: {} RW: {} SLVERR: {}".format(self.data, self.addr, self.rw, self.slverr)
 
     def __eq__(self,other):
-        if (isinstance(other, APBTransaction)):
-            return self.addr == other.addr and self.data  == other.data and self.rw == other.rw and self.slverr == other.slverr
-        else:
-            return False
+        return type(other) is APBTransaction and \
+            (self.addr, self.data, self.rw, self.slverr) == (other.addr, other.data, other.rw, other.slverr)
+
+
+@njit(cache=True, boundscheck=False)
+def _predict(reg_bank, addr, data, rw):
+    '''
+    Register bank update for a single transaction. reg_bank is updated in
+    place; returns the expected (data, slverr) pair.
+    '''
+    if (rw == 1):
+        if (addr < 16):
+            return np.int64(reg_bank[addr // 4]), 0
+        return 0, 1
+
+    if (addr < 12):
+        # The RTL uses nonblocking assignments, so reg_bank[3] is computed
+        # from the values held before this write.
+        if (addr >= 8 and reg_bank[2] & 0x80000000):
+            a = np.int64(reg_bank[2])
+            b = np.int64(reg_bank[1])
+            if (a & 1):
+                reg_bank[3] = (a + b) & 0xFFFFFFFF
+            else:
+                reg_bank[3] = (a * b) & 0xFFFFFFFF
 
+        reg_bank[addr // 4] = data
+        return data, 0
+
+    return data, 1
+
+@njit(cache=True)
+def _gen_stim(n, addr_max, seed):
+    '''
+    Uniform (addr, rw, data) stimulus for n transfers. Seeded explicitly
+    because numba keeps its own generator state apart from numpy's.
+    '''
+    np.random.seed(seed)
+
+    addrs = np.empty(n, np.uint32)
+    rws = np.empty(n, np.uint8)
+    datas = np.empty(n, np.uint32)
+
+    for i in range(n):
+        addrs[i] = np.random.randint(0, addr_max*4)
+        rws[i] = np.random.randint(0, 2)
+        datas[i] = np.random.randint(0, 2**32)
+
+    return addrs, rws, datas
 
 class ArithRefmod:
     '''
     DUT Model
     '''
 
-    def __init__ (self):
-        self.reg_bank = [None] * 4
+    __slots__ = ('reg_bank',)
 
-        for i in range(4):
-            self.reg_bank[i] = BinaryValue(value=0,n_bits=32, bigEndian=False, binaryRepresentation=BinaryRepresentation.TWOS_COMPLEMENT)
+    def __init__ (self):
+        self.reg_bank = np.zeros(4, dtype=np.uint32)
 
 
     def predict(self, tr_in):
-        tr_out = copy.copy(tr_in)
-
-        if(tr_in.rw == 1):
-            if(tr_in.addr.integer < 16):
-                tr_out.data = self.reg_bank[tr_in.addr.integer // 4]
-                tr_out.slverr <= 0
-            else:
-                tr_out.data <= 0
-                tr_out.slverr <= 1
-        else:
-            if(tr_in.addr.integer < 8):
-                self.reg_bank[tr_in.addr.integer // 4] = tr_in.data
-                tr_out.slverr <= 0
-            elif (8 <= tr_in.addr.integer < 12):
-                self.reg_bank[tr_in.addr.integer // 4] = tr_in.data
-                tr_out.slverr <= 0
-
-                if (self.reg_bank[2][31]):
-                    if (self.reg_bank[2][0]):
-                        self.reg_bank[3] <= self.reg_bank[2].integer + self.reg_bank[1].integer
-                    else:
-                        self.reg_bank[3] <= self.reg_bank[2].integer * self.reg_bank[1].integer
-            else:
-                tr_out.slverr <= 1
-        
+        tr_out = tr_in.clone()
+        tr_out.data, tr_out.slverr = _predict(self.reg_bank, tr_in.addr, tr_in.data, tr_in.rw)
         return tr_out
 
 class APBDriver(BusDriver):
@@ -108,54 +159,116 @@ class APBDriver(BusDriver):
         self.bus.psel.setimmediatevalue(0)
         self.bus.pwrite.setimmediatevalue(0)
         self.bus.penable.setimmediatevalue(0)
+
+        self._paddr = self.bus.paddr
+        self._pwrite = self.bus.pwrite
+        self._psel = self.bus.psel
+        self._penable = self.bus.penable
+        self._pwdata = self.bus.pwdata
+        self._prdata = self.bus.prdata
+        self._pready = self.bus.pready
+        self._pslverr = self.bus.pslverr
+
+        self._re = RisingEdge(self.clock)
+        self._ro = ReadOnly()
     
-    @cocotb.coroutine
-    def send(self, tr):
+    async def send(self, tr):
         
-        yield RisingEdge(self.clock)
+        await self._re
 
         if (tr.rw):
-            self.bus.paddr <= tr.addr
-            self.bus.pwrite <= 0
-            self.bus.psel <= 1
+            self._paddr <= tr.addr
+            self._pwrite <= 0
+            self._psel <= 1
+
+            await self._re
 
-            yield RisingEdge(self.clock)
+            self._penable <= 1
 
-            self.bus.penable <= 1
+            await self._ro
+            while not self._pready.value:
+                await self._re
+                await self._ro
 
-            while True:
-                yield ReadOnly()
-                if (self.bus.pready == 1):
-                    tr.data = self.bus.prdata
-                    tr.slverr = self.bus.pslverr
-                    break
-                yield RisingEdge(self.clock)
+            tr.data = self._prdata.value.integer
+            tr.slverr = self._pslverr.value.integer
             
-            yield RisingEdge(self.clock)
+            await self._re
 
-            self.bus.psel <= 0
-            self.bus.penable <= 0
+            self._psel <= 0
+            self._penable <= 0
 
         else: 
-            self.bus.paddr <= tr.addr
-            self.bus.pwrite <= 1
-            self.bus.psel <= 1
-            self.bus.pwdata <= tr.data
+            self._paddr <= tr.addr
+            self._pwrite <= 1
+            self._psel <= 1
+            self._pwdata <= tr.data
 
-            yield RisingEdge(self.clock)
+            await self._re
 
-            self.bus.penable <= 1
+            self._penable <= 1
 
-            while True:
-                yield ReadOnly()
-                if (self.bus.pready):
-                    tr.slverr = self.bus.pslverr
-                    break
+            await self._ro
+            while not self._pready.value:
+                await self._re
+                await self._ro
+
+            tr.slverr = self._pslverr.value.integer
             
-            yield RisingEdge(self.clock)
+            await self._re
+
+            self._psel <= 0
+            self._penable <= 0
+
+    async def send_many(self, trs):
+        '''
+        Drive a list of transactions back-to-back, writing the read data
+        and slverr of each transfer back into its transaction.
+        '''
+        await self.send_stim([tr.addr for tr in trs], [tr.rw for tr in trs], [tr.data for tr in trs], trs)
+
+    async def send_stim(self, addrs, rws, datas, trs=None):
+        '''
+        Drive transfers given as parallel addr/rw/data sequences of ints.
+        The SETUP phase of each transfer is driven right after the ACCESS
+        edge of the previous one, so psel is held high and no idle edge is
+        spent between transfers. If trs is given, the read data and slverr
+        of each transfer are written back into it.
+        '''
+        writes = [0 if rw else 1 for rw in rws]
+
+        paddr, pwrite, pwdata = self._paddr, self._pwrite, self._pwdata
+        psel, penable, pready = self._psel, self._penable, self._pready
+        re, ro = self._re, self._ro
+
+        await re
+
+        for i in range(len(addrs)):
+            paddr <= addrs[i]
+            pwrite <= writes[i]
+            pwdata <= datas[i]
+            psel <= 1
+            penable <= 0
+
+            await re
+
+            penable <= 1
+
+            await ro
+            while not pready.value:
+                await re
+                await ro
+
+            if (trs is not None):
+                tr = trs[i]
+                if (tr.rw):
+                    tr.data = self._prdata.value.integer
+                tr.slverr = self._pslverr.value.integer
+
+            await re
 
-            self.bus.psel <= 0
-            self.bus.penable <= 0
+        psel <= 0
+        penable <= 0
 
 class APBMonitor(BusMonitor):
     '''
@@ -167,43 +280,60 @@ class APBMonitor(BusMonitor):
     def __init__(self, entity, name, clock, callback=None, reset_n=None):
         BusMonitor.__init__(self, entity, name, clock, callback=callback, event=None, reset_n=None)
 
-    @cocotb.coroutine
-    def _monitor_recv(self):
-        transCollected = APBTransaction()
-        transCollected.randomize()
+    async def _monitor_recv(self):
+        transCollected = APBTransaction.__new__(APBTransaction)
+        transCollected.data = 0
+        transCollected.addr = 0
+        transCollected.rw = 0
+        transCollected.slverr = 0
+
+        bus = self.bus
+        clk = self.clock
+        re = RisingEdge(clk)
+        ro = ReadOnly()
+        recv = self._recv
+
+        # The 1-bit controls are sampled every cycle, so read them as plain
+        # ints through the GPI handle instead of building a BinaryValue per
+        # signal. penable goes first because it is low on most cycles in
+        # which no transfer completes.
+        penable_long = bus.penable._handle.get_signal_val_long
+        pready_long = bus.pready._handle.get_signal_val_long
+        psel_long = bus.psel._handle.get_signal_val_long
 
         while True:
-            yield RisingEdge(self.clock)
+            await re
+            await ro
+
+            if (penable_long() and pready_long() and psel_long()):
+                pwrite_v = bus.pwrite.value.integer
+
+                transCollected.addr = bus.paddr.value.integer
+                transCollected.slverr = bus.pslverr.value.integer
             
-            if (self.bus.psel == 1 and self.bus.penable == 1):
-                while True:
-                    yield ReadOnly()
-                    if (self.bus.pready):
-                        transCollected.addr = self.bus.paddr.value
-                        transCollected.slverr = self.bus.pslverr.value
-                    
-                        if (self.bus.pwrite == 1):
-                            transCollected.data = self.bus.pwdata.value
-                        else:
-                            transCollected.data = self.bus.prdata.value
-
-                        transCollected.rw <= 0 if self.bus.pwrite else 1
-                        break
+                if (pwrite_v):
+                    transCollected.data = bus.pwdata.value.integer
+                    transCollected.rw = 0
+                else:
+                    transCollected.data = bus.prdata.value.integer
+                    transCollected.rw = 1
             
-                self._recv(transCollected)
+                recv(transCollected)
 
 class ArithTB(object):
     def __init__(self, dut):
 
         self.missmatch = 0
 
+        self.log = logging.getLogger("ArithTB")
+
         self.dut = dut
 
         self.driver = APBDriver(entity=dut, clock=dut.pclk, name=None)
 
-        self.exp_out = []
+        self.exp_out = deque()
 
-        self.rec_out = []
+        self.rec_out = deque()
 
         self.refmod = ArithRefmod()
 
@@ -212,34 +342,42 @@ class ArithTB(object):
         self.dut_mon = APBMonitor(entity=dut, name=None, clock=dut.pclk, reset_n=dut.presetn, callback=self.model)
 
     def model(self, transaction):        
-        tr_in = copy.copy(transaction)
-        # tr_in.print_tr()
-        tr_out = self.refmod.predict(tr_in)
+        tr_out = self.refmod.predict(transaction)
         self.exp_out.append(tr_out)
-        self.compare()
+        self._drain()
 
     def rec(self, transaction):
-        self.rec_out.append(transaction)
-        self.compare()
+        # The monitor reuses its transaction object, so keep a copy until
+        # the matching prediction arrives.
+        self.rec_out.append(transaction.clone())
+
+    def _drain(self):
+        exp_out = self.exp_out
+        rec_out = self.rec_out
 
-    def compare(self):
-        if(len(self.exp_out) and len(self.rec_out)):
+        while exp_out and rec_out:
+            exp = exp_out.popleft()
+            rec = rec_out.popleft()
 
-            if(self.exp_out[-1] == self.rec_out[-1]):
-                print("[COMPARATOR MATCH]")
+            if(exp == rec):
+                self.log.debug("[COMPARATOR MATCH]")
             else:
-                print("[COMPARATOR MISSMATCH]")
-                print("Expected: ")
-                self.exp_out[-1].print_tr()
-                print("Received: ")
-                self.rec_out[-1].print_tr()
-                
+                self.log.error("[COMPARATOR MISSMATCH] Expected: %s Received: %s", exp, rec)
                 self.missmatch += 1
 
-            self.exp_out.pop()
-            self.rec_out.pop()
-        else:
-            pass       
+    def check(self):
+        '''
+        End-of-test check: compares whatever the model callback has not
+        drained yet and returns True if every pair matched and nothing is
+        left without a counterpart.
+        '''
+        self._drain()
+
+        if (self.exp_out or self.rec_out):
+            self.log.error("[COMPARATOR UNMATCHED] %d expected, %d received", len(self.exp_out), len(self.rec_out))
+            return False
+
+        return self.missmatch == 0
 
 async def reset(dut):
     dut.presetn <= 1
@@ -248,34 +386,18 @@ async def reset(dut):
     await Timer(200, units='ns')
     dut.presetn <= 1    
 
-
-def setup_dut(dut):
-    clock = Clock(dut.pclk, CLK_PERIOD_NS, units="ns")  # Create a 10us period clock on port clk
-    cocotb.fork(clock.start())  # Start the clock
-
 @cocotb.test()
 async def simple_test(dut):
     """Simple Test"""
 
-    cycles = 0
-
-    setup_dut(dut)
-
     await reset(dut)
     tb = ArithTB(dut)
-    tr = APBTransaction()
 
-    while (True):
+    addrs, rws, datas = _gen_stim(NUM_TRANSACTIONS, APBTransaction.ADDR_MAX, random.getrandbits(32))
 
-        tr.randomize()
-        
-        await tb.driver.send(tr)
+    await tb.driver.send_stim(addrs.tolist(), rws.tolist(), datas.tolist())
 
-        cycles += 1
-        if (cycles >= 10000):
-            break
-    
-    if (tb.missmatch == 0):
+    if (tb.check()):
         raise TestSuccess("============= PASS =============")
     else:
         raise TestFailure("============= FAIL =============")
\ No newline at end of file